@@ -1,19 +1,53 @@
+"""
+    基于aiomysql的简单异步ORM。
+    批量插入请使用Model.save_many()；互不依赖的多个查询可用asyncio.gather()并发执行，
+例如 await asyncio.gather(User.find(id1), User.find(id2), Blog.findAll())，
+它们会使用连接池中不同的连接，总耗时接近最慢的一次查询而不是各次之和。
+"""
+import os
+import time
 import logging
 import asyncio
+import functools
+from collections import OrderedDict
 import aiomysql
 
+# SELECT结果缓存：(sql, args, size) ==> (过期时间, 结果)
+_cache = OrderedDict()
+_CACHE_SIZE = 1024
+_CACHE_TTL = 5
+# 写操作计数，每次invalidate()加1，查询期间发生过写操作则不缓存其结果
+_generation = 0
+# 正在执行的SELECT：((sql, args, size), 写操作计数) ==> Task，相同查询并发时共享结果
+_inflight = {}
+
+
+# aiomysql只支持文本协议，参数在客户端转义后拼入SQL发送，没有服务端预处理语句可用，
+# 因此只在客户端缓存占位符转换后的SQL，Model的固定语句在定义时即已转换。
+@functools.lru_cache(maxsize=512)
+def _translate(sql):
+    """
+        将SQL语句的占位符?替换为MySQL的占位符%s，结果按SQL语句缓存。
+    """
+    return sql.replace('?', '%s')
+
 
 def log(sql, args=()):
     logging.info('''SQL: %s
-        args: %s''' % (sql, str(args)))
+        args: %s''', sql, args)
 
 
 async def create_pool(loop, **kw):
     """
        创建全局连接池，每个HTTP请求都可以从连接池中直接获取数据库连接。使用连接池的好处
     是不必频繁地打开和关闭数据库连接，而是能复用就尽量复用。
+        连接数上限为CPU核数*2+1，但不超过maxsize（默认10）；pool_recycle秒后回收
+    连接，避免复用已被MySQL因wait_timeout断开的连接。
     """
-    logging.info('create database connection pool...')
+    maxsize = min((os.cpu_count() or 2) * 2 + 1, kw.get('maxsize', 10))
+    minsize = min(kw.get('minsize', 1), maxsize)
+    logging.info('create database connection pool (minsize: %s, maxsize: %s)...',
+                 minsize, maxsize)
     global __pool
     __pool = await aiomysql.create_pool(
         host=kw.get('host', 'localhost'),
@@ -23,52 +57,174 @@ async def create_pool(loop, **kw):
         db=kw['db'],
         charset=kw.get('charset', 'utf8'),
         autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
+        maxsize=maxsize,
+        minsize=minsize,
+        pool_recycle=kw.get('pool_recycle', 1800),
+        connect_timeout=kw.get('connect_timeout', 5),
+        echo=kw.get('echo', False),
         loop=loop
     )
 
 
-async def select(sql, args, size=None):
+async def select(sql, args, size=None, translated=False):
     """
         封装SELECT语句，需要传入SQL语句和SQL参数。
         SQL语句的占位符是?，而MySQL的占位符是%s，select()函数在内部自动替换。注意要始终
     使用带参数的SQL，而不是自己拼接SQL字符串，这样可以防止SQL注入攻击。
-        fetchmany()获取最多指定数量的记录，fetch()获取所有记录。
+        fetchmany()获取最多指定数量的记录，fetch()获取所有记录。translated为True时表示
+    sql已使用%s占位符，不再做替换。返回的每条记录是按SELECT列顺序排列的tuple。
+        查询结果会在_CACHE_TTL秒内缓存，execute()执行写操作时清空缓存，查询期间发生
+    过写操作的结果不缓存。相同的查询并发执行时只访问一次数据库。args不是由标量组成的
+    tuple或list时不使用缓存。
+    """
+    if not translated:
+        sql = _translate(sql)
+    key = _cache_key(sql, args, size)
+    if key is None:
+        return await _select(sql, args, size)
+    entry = _cache.get(key)
+    if entry is not None:
+        if entry[0] > time.monotonic():
+            _cache.move_to_end(key)
+            logging.info('rows returned from cache: %s', len(entry[1]))
+            return entry[1]
+        del _cache[key]
+    # 写操作之后到达的查询不与写操作之前开始的查询共享结果
+    inflight_key = (key, _generation)
+    task = _inflight.get(inflight_key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch(inflight_key, sql, args, size))
+        # 等待者都已取消时避免asyncio报告未获取的异常
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _inflight[inflight_key] = task
+    # 某个调用者被取消时不取消共享的查询，其他等待者仍能得到结果
+    return await asyncio.shield(task)
+
+
+async def _fetch(inflight_key, sql, args, size):
+    key, generation = inflight_key
+    try:
+        rs = await _select(sql, args, size)
+    finally:
+        del _inflight[inflight_key]
+    if generation == _generation:
+        _cache[key] = (time.monotonic() + _CACHE_TTL, rs)
+        if len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return rs
+
+
+def _cache_key(sql, args, size):
+    """
+        生成查询缓存的键。参数不是由可哈希的标量组成的tuple或list时（例如供IN %s展开
+    的list，或%(name)s形式的dict参数）返回None，表示不缓存。
     """
+    if not args:
+        return (sql, (), size)
+    if not isinstance(args, (tuple, list)):
+        return None
+    for a in args:
+        if isinstance(a, (tuple, list, dict, set, frozenset)):
+            return None
+        try:
+            hash(a)
+        except TypeError:
+            return None
+    return (sql, tuple(args), size)
+
+
+async def _select(sql, args, size):
     log(sql, args)
     global __pool
     async with __pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())
+        async with conn.cursor() as cur:
+            await cur.execute(sql, args or ())
             if size:
                 rs = await cur.fetchmany(size)
             else:
                 rs = await cur.fetchall()
-        logging.info('rows returned: %s' % len(rs))
+        logging.info('rows returned: %s', len(rs))
         return rs
 
 
-async def execute(sql, args, autocommit=True):
+async def select_iter(sql, args, batch=200):
+    """
+        使用服务端游标（SSCursor）执行SELECT语句，每次从服务器读取batch条记录并逐条
+    返回，内存占用与结果集大小无关。结果不经过查询缓存。
+        遍历期间一直占用连接池中的一个连接。提前退出（break）时生成器不会立即关闭，
+    连接要等到垃圾回收时才归还，因此调用者必须显式关闭生成器，例如：
+        async with contextlib.aclosing(select_iter(sql, args)) as rows:
+            async for r in rows:
+                ...
+    或在finally中调用await rows.aclose()。
+    """
+    log(sql, args)
+    async with __pool.acquire() as conn:
+        async with conn.cursor(aiomysql.SSCursor) as cur:
+            await cur.execute(_translate(sql), args or ())
+            while True:
+                rows = await cur.fetchmany(batch)
+                if not rows:
+                    break
+                for r in rows:
+                    yield r
+
+
+def invalidate(table=None):
+    """
+        清除SELECT结果缓存。指定table时只清除引用了该表的缓存。
+    """
+    global _generation
+    _generation += 1
+    if table is None:
+        _cache.clear()
+        return
+    name = '`%s`' % table
+    for key in [k for k in _cache if name in k[0]]:
+        del _cache[key]
+
+
+async def execute(sql, args, autocommit=True, translated=False):
+    """
+        封装INSERT、UPDATE、DELETE语句。translated为True时表示sql已使用%s占位符，
+    不再做替换。autocommit为False时在事务中执行，出错则回滚。
+    """
     log(sql, args)
+    if not translated:
+        sql = _translate(sql)
+    try:
+        if autocommit:
+            return await _execute_autocommit(sql, args)
+        return await _execute_tx(sql, args)
+    finally:
+        # 出错或被取消时服务器可能已执行了该语句，仍然清空缓存
+        invalidate()
+
+
+async def _execute_autocommit(sql, args):
+    async with __pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(sql, args)
+            return cur.rowcount
+
+
+async def _execute_tx(sql, args):
     async with __pool.acquire() as conn:
-        if not autocommit:
-            await conn.begin()
+        await conn.begin()
         try:
             async with conn.cursor() as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
+                await cur.execute(sql, args)
                 affected = cur.rowcount
-            if not autocommit:
-                await conn.commit()
-        except BaseException as e:
-            if not autocommit:
-                await conn.rollback()
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
             raise
         return affected
 
 
+@functools.lru_cache(maxsize=64)
 def create_args_string(num):
-    return ','.join(['?'] * num)
+    return '?' + ',?' * (num - 1) if num > 0 else ''
 
 
 class Field(object):
@@ -146,7 +302,8 @@ class ModelMetaclass(type):
         # 获取table名称
         tableName = attrs.get('__table__', None) or name
         logging.info('found model: %s (table: %s)' % (name, tableName))
-        # 获取所有的Field和主键名
+        # 获取所有的Field和主键名，其余属性保留在new_attrs中
+        new_attrs = dict()
         mappings = dict()
         fields = []
         primaryKey = None
@@ -162,32 +319,59 @@ class ModelMetaclass(type):
                     primaryKey = k
                 else:
                     fields.append(k)
+            else:
+                new_attrs[k] = v
         if not primaryKey:
             raise RuntimeError('Primary key not found.')
-        for k in mappings.keys():
-            attrs.pop(k)
+        attrs = new_attrs
 
-        escaped_fields = list(map(lambda f: '`%s`' %
-                                  (mappings.get(f).name or f), fields))
-        pk = mappings.get(primaryKey).name or primaryKey
+        escaped_fields = [f'`{mappings[f].name or f}`' for f in fields]
+        pk = mappings[primaryKey].name or primaryKey
+        # 属性都保存在dict中，不需要实例的__dict__和__weakref__
+        attrs.setdefault('__slots__', ())
         attrs['__mappings__'] = mappings  # 保存属性到列的映射关系
+        # 保存属性的默认值及默认值是否可调用
+        attrs['__defaults__'] = {k: (v.default, callable(v.default))
+                                 for k, v in mappings.items()}
         attrs['__table__'] = tableName  # 保存表名
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 保存除主键外的属性名
+        # 与SELECT、INSERT语句列顺序一致的属性名，主键在前
+        attrs['__fields_with_pk__'] = (primaryKey,) + tuple(fields)
+        # 与UPDATE语句参数顺序一致的属性名，主键在后
+        attrs['__update_fields__'] = tuple(fields) + (primaryKey,)
+        # 生成按__fields_with_pk__顺序接收位置参数的初始化函数，供_from_row()使用
+        params = ', '.join('v%d' % i for i in range(len(fields) + 1))
+        src = 'def __init_fast__(self, %s):\n%s\n' % (params, '\n'.join(
+            '    self[%r] = v%d' % (k, i) for i, k in enumerate(attrs['__fields_with_pk__'])))
+        ns = {}
+        exec(src, ns)
+        attrs['__init_fast__'] = ns['__init_fast__']
         # 构造默认的SELECT，INSERT，UPDATE和DELETE语句
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (
             pk, ','.join(escaped_fields), tableName)
-        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values(%s)' % (
-            tableName, ','.join(escaped_fields), pk, create_args_string(len(fields) + 1))
+        attrs['__select_by_pk__'] = '%s where `%s` = ?' % (
+            attrs['__select__'], pk)
+        attrs['__insert__'] = 'insert into `%s` (`%s`, %s) values(%s)' % (
+            tableName, pk, ','.join(escaped_fields), create_args_string(len(fields) + 1))
+        attrs['__insert_placeholder__'] = '(%s)' % create_args_string(
+            len(fields) + 1).replace('?', '%s')
+        attrs['__insert_head_sql__'] = 'insert into `%s` (`%s`, %s) values ' % (
+            tableName, pk, ','.join(escaped_fields))
         attrs['__update__'] = 'update `%s` set %s where `%s` = ?' % (
-            tableName, ','.join(map(lambda f: '%s=?' % f, escaped_fields)), pk)
+            tableName, ','.join(f'{f}=?' for f in escaped_fields), pk)
         attrs['__delete__'] = 'delete from `%s` where `%s` = ?' % (
             tableName, pk)
+        # 预先转换为MySQL占位符的语句，供Model直接使用
+        for k in ('select_by_pk', 'insert', 'update', 'delete'):
+            attrs['__%s_sql__' % k] = attrs['__%s__' % k].replace('?', '%s')
         return type.__new__(cls, name, bases, attrs)
 
 
 class Model(dict, metaclass=ModelMetaclass):
 
+    __slots__ = ()
+
     def __init__(self, **kw):
         super().__init__(**kw)
 
@@ -210,40 +394,50 @@ class Model(dict, metaclass=ModelMetaclass):
         """
             根据传入的键获取对应的值，如果不存在则返回None。
         """
-        return getattr(self, key, None)
+        return dict.get(self, key)
 
     def getValueOrDefault(self, key):
         """
             根据传入的键获取对应的值，如果键不存在则判断是否有设置默认值，有默认值则
         返回默认值，并设置该字段。
         """
-        value = getattr(self, key, None)
+        value = dict.get(self, key)
         if value is None:
-            field = self.__mappings__[key]
-            if field.default is not None:
-                value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s: %s' %
-                              (key, str(value)))
-                setattr(self, key, value)
+            default, is_callable = self.__defaults__[key]
+            if default is not None:
+                value = default() if is_callable else default
+                logging.debug('using default value for %s: %s', key, value)
+                self[key] = value
         return value
 
+    @classmethod
+    def _from_row(cls, row):
+        ' 由按__fields_with_pk__顺序排列的记录构造对象'
+        obj = cls.__new__(cls)
+        cls.__init_fast__(obj, *row)
+        return obj
+
+    @classmethod
+    def invalidate(cls):
+        ' 清除该表的查询缓存'
+        invalidate(cls.__table__)
+
     @classmethod
     async def find(cls, pk):
         ' 通过主键查询'
-        rs = await select('%s where `%s` = ?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        rs = await select(cls.__select_by_pk_sql__, (pk,), 1, translated=True)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls._from_row(rs[0])
 
     @classmethod
-    async def findAll(cls, where=None, args=None, **kw):
-        ' 通过where查询'
+    def _build_select(cls, where=None, args=None, **kw):
+        ' 根据where、orderBy、limit构造SELECT语句和参数'
         sql = [cls.__select__]
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
+        args = list(args) if args else []
         orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
@@ -259,8 +453,32 @@ class Model(dict, metaclass=ModelMetaclass):
                 args.extend(limit)
             else:
                 raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        return [cls(**r) for r in rs]
+        return ' '.join(sql), args
+
+    @classmethod
+    async def findAll(cls, where=None, args=None, **kw):
+        ' 通过where查询'
+        sql, args = cls._build_select(where, args, **kw)
+        rs = await select(sql, args)
+        return [cls._from_row(r) for r in rs]
+
+    @classmethod
+    async def iter(cls, where=None, args=None, batch=200, **kw):
+        """
+            通过where查询，逐条返回对象而不是一次性读入全部结果，适合遍历大量记录。
+        参数与findAll()相同，结果不经过查询缓存。与select_iter()一样，遍历期间占用
+        一个连接，调用者必须关闭生成器，例如：
+            async with contextlib.aclosing(User.iter('admin=?', [True])) as users:
+                async for u in users:
+                    ...
+        """
+        sql, args = cls._build_select(where, args, **kw)
+        rows = select_iter(sql, args, batch)
+        try:
+            async for r in rows:
+                yield cls._from_row(r)
+        finally:
+            await rows.aclose()
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
@@ -272,29 +490,47 @@ class Model(dict, metaclass=ModelMetaclass):
         rs = await select(' '.join(sql), args, 1)
         if len(rs) == 0:
             return None
-        return rs[0]['_num_']
+        return rs[0][0]
 
     async def save(self):
         ' 插入数据到数据库'
-        args = list(map(self.getValueOrDefault, self.__fields__))
-        args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        args = tuple(self.getValueOrDefault(k) for k in self.__fields_with_pk__)
+        rows = await execute(self.__insert_sql__, args, translated=True)
         if rows != 1:
-            logging.warn('faild to insert record: affected rows: %s' % rows)
+            logging.warning('faild to insert record: affected rows: %s', rows)
+
+    @classmethod
+    async def save_many(cls, objs, batch=1000):
+        """
+            批量插入数据到数据库，每batch条记录合并为一条多行INSERT语句，以减少与数据库
+        的往返次数。batch不宜过大，以免超过MySQL的max_allowed_packet限制。
+        """
+        objs = list(objs)
+        total = 0
+        for i in range(0, len(objs), batch):
+            chunk = objs[i:i + batch]
+            args = []
+            for o in chunk:
+                args.extend(o.getValueOrDefault(k) for k in cls.__fields_with_pk__)
+            sql = cls.__insert_head_sql__ + ','.join([cls.__insert_placeholder__] * len(chunk))
+            total += await execute(sql, args, translated=True)
+        if total != len(objs):
+            logging.warning('faild to insert records: affected rows: %s of %s',
+                            total, len(objs))
+        return total
 
     async def update(self):
         ' 更新数据到数据库'
-        args = list(map(self.getValue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        args = tuple(self.getValue(k) for k in self.__update_fields__)
+        rows = await execute(self.__update_sql__, args, translated=True)
         if rows != 1:
-            logging.warn(
-                'failed to update by primary key: affected rows: %s' % rows)
+            logging.warning(
+                'failed to update by primary key: affected rows: %s', rows)
 
     async def remove(self):
         ' 从数据库删除记录'
-        args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        args = (self.getValue(self.__primary_key__),)
+        rows = await execute(self.__delete_sql__, args, translated=True)
         if rows != 1:
-            logging.warn(
-                'failed to remove by primary key: affected rows: %s' % rows)
+            logging.warning(
+                'failed to remove by primary key: affected rows: %s', rows)
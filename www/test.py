@@ -12,6 +12,10 @@ async def test(loop):
              passwd='123456', image='about:blank')
     await u.save()
     print(u.name)
+    # 互不依赖的查询可并发执行
+    u, users, num = await asyncio.gather(
+        User.find(u.id), User.findAll(limit=5), User.findNumber('count(*)'))
+    print(u, len(users), num)
     # u = await User.findNumber(selectField='count(*)')
     # print(u)
 